@@ -448,8 +448,12 @@ def _bundle_product_download(bundle_product_descriptor, product_name):
     # And untar the content inside the installer
     start = time.time()
     print(f"    Untarring /tmp/{product_name}.tar.gz")
-    with tarfile.open(f"/tmp/{product_name}.tar.gz", mode="r:*") as tf:
-        tf.extractall(path=installation_path)
+    with open(f"/tmp/{product_name}.tar.gz", "rb") as fd:
+        # The archive is read once, from start to end: let the kernel read ahead
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with tarfile.open(fileobj=fd, mode="r:*") as tf:
+            tf.extractall(path=installation_path)
     seconds = int(time.time() - start)
     print(f"         => completed in {seconds} seconds")
 
@@ -3,17 +3,28 @@
 # pylint: disable=import-outside-toplevel
 # pylint: disable=consider-using-with
 # pylint: disable=unspecified-encoding
+import contextlib
+import io
 import json
 import logging
 import os.path
+import shutil
 import uuid
 import sys
 import tarfile
+import threading
 import time
 import xml.dom.minidom
+from concurrent.futures import ThreadPoolExecutor
 
 from nexus import NexusRepository
 
+try:
+    # Optional: ISA-L based gzip decompression, much faster than zlib
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
 DEV_DIR = "/home/konverso/dev/"
 WORK_DIR = os.path.join(DEV_DIR, "work")
 BIN_DIR = os.path.join(WORK_DIR, "bin")
@@ -22,6 +33,18 @@ PYTHON_PATH = os.path.join(BIN_DIR, "python.sh")
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+# Number of threads writing the untarred files to disk
+EXTRACT_WORKERS = 8
+
+# Larger files are streamed to disk while reading the archive, instead of
+# being loaded in memory and handed to the writing threads
+EXTRACT_IN_MEMORY_SIZE = 1024 * 1024
+
+# Size of the read buffer between the download and tarfile. tarfile itself
+# must keep its small default bufsize: it re-slices its whole buffer on every
+# 512 bytes header read, which gets very slow with a large one
+STREAM_BUFFER_SIZE = 1024 * 1024
+
 LOG_FILE = "automatic_kbot_actions.log"
 LOG_FILENAME = os.path.join(DEV_DIR, LOG_FILE)
 
@@ -471,6 +494,105 @@ def recurse_product_download(nexus_files, product_name, version, recurse=True, u
         recurse_product_download(nexus_files, parent, version, uses=uses)
 
 
+@contextlib.contextmanager
+def _open_tar_stream(stream):
+    """Returns a TarFile reading the given tar.gz stream sequentially.
+
+    When python-isal is available, the gzip decompression runs with ISA-L
+    in a background thread, in parallel of the tar extraction
+    """
+    if igzip_threaded is None:
+        # tarfile reads 10 KB at a time, these are served from a larger buffer
+        # rather than each going down to the HTTP response
+        with io.BufferedReader(stream, STREAM_BUFFER_SIZE) as buffered_stream, \
+                tarfile.open(fileobj=buffered_stream, mode="r|*") as tf:
+            yield tf
+        return
+
+    with igzip_threaded.open(stream, "rb", threads=1) as gz_stream, \
+            tarfile.open(fileobj=gz_stream, mode="r|") as tf:
+        yield tf
+
+
+def _extract_tar_stream(tf, path):
+    """Extract all the members of the given stream TarFile inside path.
+
+    Regular files up to EXTRACT_IN_MEMORY_SIZE are written to disk by a
+    pool of threads while the archive is still being read, holding at most
+    2 * EXTRACT_WORKERS of them in memory. Larger files and other members
+    are extracted by the TarFile itself.
+    """
+    in_flight = threading.BoundedSemaphore(2 * EXTRACT_WORKERS)
+
+    def write_file(member, targetpath, data):
+        try:
+            with open(targetpath, "wb") as fd:
+                fd.write(data)
+            _set_tar_attributes(tf, member, targetpath)
+        finally:
+            in_flight.release()
+
+    directories = []
+    # Folders known to exist, so that each one is only created once
+    created_paths = set()
+    # Files being written by the pool, by path
+    pending = {}
+
+    def collect(items):
+        """Forget the given pending writes, raising their errors if any"""
+        for targetpath, future in list(items):
+            del pending[targetpath]
+            future.result()
+
+    with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+        for member in tf:
+            # Fail on the first write error (disk full...) rather than
+            # once the whole archive has been downloaded
+            collect([item for item in pending.items() if item[1].done()])
+
+            targetpath = os.path.join(path, member.name)
+            if member.islnk():
+                # The hard link target must have been written first
+                collect(pending.items())
+            elif targetpath in pending:
+                # The last member with a given path must win, as in extractall
+                collect([(targetpath, pending[targetpath])])
+
+            if member.isreg():
+                upperdirs = os.path.dirname(targetpath)
+                if upperdirs not in created_paths:
+                    os.makedirs(upperdirs, exist_ok=True)
+                    created_paths.add(upperdirs)
+                if member.size <= EXTRACT_IN_MEMORY_SIZE:
+                    data = tf.extractfile(member).read()
+                    in_flight.acquire()
+                    pending[targetpath] = executor.submit(write_file, member, targetpath, data)
+                    continue
+            elif member.isdir():
+                # Attributes are set at the end, as extractall does, in case
+                # the directory is not writable
+                directories.append(member)
+                created_paths.add(targetpath.rstrip("/"))
+
+            tf.extract(member, path=path, set_attrs=not member.isdir())
+
+        collect(pending.items())
+
+    directories.sort(key=lambda member: member.name, reverse=True)
+    for member in directories:
+        _set_tar_attributes(tf, member, os.path.join(path, member.name))
+
+
+def _set_tar_attributes(tf, member, targetpath):
+    """Set the owner, modification time and mode of an untarred member"""
+    try:
+        tf.chown(member, targetpath, False)
+        tf.utime(member, targetpath)
+        tf.chmod(member, targetpath)
+    except tarfile.ExtractError as e:
+        log.debug("Failed setting attributes of %s: %s", targetpath, e)
+
+
 def _nexus_download_and_install(nexus_file, product_name):
     """install (replace eventually) the given product using the given Nexus definition file
 
@@ -479,38 +601,45 @@ def _nexus_download_and_install(nexus_file, product_name):
 
     global backup
 
-    print(f"    Downloading product {product_name}  using Nexus file: {nexus_file}")
-    start = time.time()
-    nexus_file.download(f"/tmp/{product_name}.tar.gz")
-    seconds = int(time.time() - start)
-    print(f"         => completed in {seconds} seconds")
-
-    # Untar / Unzip the file
-    # Backup is another global variable
-    if not backup or backup == "none":
-        os.system(f"rm -rf {installation_path}/{product_name}")
-    elif backup == "folder":
-        backup_version = 1
-        while True:
-            backup_folder = (
-                f"{installation_path}/{product_name}.backup.{backup_version}"
-            )
-            if os.path.exists(backup_folder):
-                backup_version += 1
-            else:
-                break
-        os.rename(f"{installation_path}/{product_name}", backup_folder)
+    # The archive is untarred while it is being downloaded, in a staging
+    # folder next to the product, such that a failed download does not
+    # leave a half installed product behind.
+    staging_path = f"{installation_path}/.{product_name}.download"
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.mkdir(staging_path)
 
-    # And untar the content inside the installer
+    print(f"    Downloading and untarring product {product_name}  using Nexus file: {nexus_file}")
     start = time.time()
-    print(f"    Untarring /tmp/{product_name}.tar.gz")
-    with tarfile.open(f"/tmp/{product_name}.tar.gz", mode="r:*") as tf:
-        tf.extractall(path=installation_path)
-    seconds = int(time.time() - start)
-    print(f"         => completed in {seconds} seconds")
-
-    # Cleanup the archive tar file
-    os.unlink(f"/tmp/{product_name}.tar.gz")
+    try:
+        with nexus_file.open() as stream, _open_tar_stream(stream) as tf:
+            _extract_tar_stream(tf, staging_path)
+        seconds = int(time.time() - start)
+        print(f"         => completed in {seconds} seconds")
+
+        # Only touch the installed product once the new one is complete
+        if not os.path.isdir(f"{staging_path}/{product_name}"):
+            raise RuntimeError(f"Nexus file {nexus_file} has no '{product_name}' folder")
+
+        # Replace the current product
+        # Backup is another global variable. Any value other than "folder"
+        # is handled as "none"
+        if backup == "folder" and os.path.exists(f"{installation_path}/{product_name}"):
+            backup_version = 1
+            while True:
+                backup_folder = (
+                    f"{installation_path}/{product_name}.backup.{backup_version}"
+                )
+                if os.path.exists(backup_folder):
+                    backup_version += 1
+                else:
+                    break
+            os.rename(f"{installation_path}/{product_name}", backup_folder)
+        else:
+            os.system(f"rm -rf {installation_path}/{product_name}")
+
+        os.rename(f"{staging_path}/{product_name}", f"{installation_path}/{product_name}")
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
 
     # Write a STAMP file, as a marker of this activity, and to serve
     # the purpose of time marker for differences
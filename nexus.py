@@ -1,8 +1,24 @@
+import io
 import shutil
+import socket
+import threading
 from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 
 import requests
 
+# Large files are downloaded through this many parallel range requests,
+# each of them fetching a chunk of the given size
+RANGE_CONNECTIONS = 4
+RANGE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# A range request interrupted by a network error (or stalled for longer than
+# the timeout, in seconds) is resumed from its last received byte, this many times
+RANGE_RETRIES = 3
+RANGE_TIMEOUT = 60
+
 class HttpError(Exception):
     def __init__(self, response, message=""):
         """Represents an HttpError
@@ -16,6 +32,115 @@ class HttpError(Exception):
     def __str__(self):
         return "HttpError(%s, %s)" % (self.response.status_code, self.message)
 
+class RangeReader(io.RawIOBase):
+    """
+        A file-like object reading a remote file through parallel HTTP range
+        requests. Chunks are fetched ahead by a pool of threads and returned
+        in order, such that at most 'connections' chunks are held in memory.
+    """
+
+    def __init__(self, session, url, headers, size, connections=RANGE_CONNECTIONS, chunk_size=RANGE_CHUNK_SIZE):
+        super().__init__()
+        self.session = session
+        self.url = url
+        self.headers = headers
+        self.size = size
+        self.chunk_size = chunk_size
+
+        self._executor = ThreadPoolExecutor(max_workers=connections)
+        self._pending = deque()
+        # Set on close, to stop the range requests still running. Their
+        # responses are kept to shut down their sockets, in case they stall
+        self._closing = threading.Event()
+        self._responses = set()
+        self._responses_lock = threading.Lock()
+        self._next_offset = 0
+        self._chunk = memoryview(b"")
+
+        for _ in range(connections):
+            self._submit_next()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._chunk:
+            if not self._pending:
+                return 0
+            self._chunk = memoryview(self._pending.popleft().result())
+            self._submit_next()
+
+        count = min(len(buffer), len(self._chunk))
+        buffer[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+    def close(self):
+        if not self.closed:
+            self._closing.set()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._pending.clear()
+            with self._responses_lock:
+                for response in self._responses:
+                    self._abort(response)
+        super().close()
+
+    def _submit_next(self):
+        if self._next_offset >= self.size:
+            return
+
+        start = self._next_offset
+        end = min(start + self.chunk_size, self.size) - 1
+        self._next_offset = end + 1
+        self._pending.append(self._executor.submit(self._get_range, start, end))
+
+    def _get_range(self, start, end):
+        size = end - start + 1
+        data = bytearray()
+        for attempt in range(RANGE_RETRIES + 1):
+            if self._closing.is_set():
+                raise IOError(f"Reader of '{self.url}' closed")
+
+            headers = self.headers.copy()
+            headers["Range"] = f"bytes={start + len(data)}-{end}"
+            headers["Accept-Encoding"] = "identity"
+            try:
+                with self.session.get(self.url, headers=headers, stream=True, timeout=RANGE_TIMEOUT) as response:
+                    with self._responses_lock:
+                        self._responses.add(response)
+                        if self._closing.is_set():
+                            self._abort(response)
+                    try:
+                        if response.status_code != 206:
+                            raise HttpError(response, f"Failed to load range {start}-{end} of '{self.url}'")
+                        for block in response.iter_content(64 * 1024):
+                            if self._closing.is_set():
+                                break
+                            data += block
+                    finally:
+                        with self._responses_lock:
+                            self._responses.discard(response)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt == RANGE_RETRIES or self._closing.is_set():
+                    raise
+
+            if len(data) >= size:
+                return data
+
+        raise IOError(f"Incomplete range {start}-{end} of '{self.url}'")
+
+    @staticmethod
+    def _abort(response):
+        """Shut down the socket of the response, waking up a thread blocked reading it.
+        Closing the response instead would wait for that read to complete
+        """
+        connection = response.raw.connection
+        if connection and connection.sock:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
 class NexusFiles(list):
     """
         A list of Nexus files, with utility functions to filter out things
@@ -38,35 +163,19 @@ class NexusFiles(list):
            such that it is possible to chain them
         """
 
-        files = list(self)
+        def match(x):
+            return ((not folder_name or x.folder_name == folder_name)
+                    and (not folder_starts_with or x.folder_name.startswith(folder_starts_with))
+                    and (not name or x.name == name)
+                    and (not ends_with or x.name.endswith(ends_with))
+                    and (not not_ends_with or not x.name.endswith(not_ends_with))
+                    and (not contains or contains in x.path))
 
-        if folder_name:
-            files = [x for x in files if x.folder_name == folder_name]
-
-        if folder_starts_with:
-            files = [x for x in files if x.folder_name.startswith(folder_starts_with)]
-
-        if name:
-            files = [x for x in files if x.name == name]
-
-        if ends_with:
-            files = [x for x in files if x.name.endswith(ends_with)]
-
-        if not_ends_with:
-            files = [x for x in files if not x.name.endswith(not_ends_with)]
-
-        if contains:
-            files = [x for x in files if contains in x.path]
-
-        return NexusFiles(self.nexus, files)
+        # Single pass over the files, rather than one intermediate list per criterion
+        return NexusFiles(self.nexus, [x for x in self if match(x)])
 
     def latest(self):
-        files = list(self)
-        files.sort(key=lambda x: x.js.get("lastModified"), reverse=True)
-        if files:
-            return files[0]
-
-        return None
+        return max(self, key=lambda x: x.js.get("lastModified"), default=None)
 
     def delete(self):
         """
@@ -121,7 +230,7 @@ class NexusFile:
     def __repr__(self):
         return str(self)
 
-    @property
+    @cached_property
     def name(self):
         path = self.js.get("path")
         if not path:
@@ -129,7 +238,7 @@ class NexusFile:
 
         return path.rsplit("/", 1)[-1]
 
-    @property
+    @cached_property
     def folder_name(self):
         path = self.js.get("path")
         if not path:
@@ -149,6 +258,10 @@ class NexusFile:
         """ Download this file to the target file"""
         self.nexus.get_file(f"/{self.repository_name}/{self.path}", target)
 
+    def open(self):
+        """ Returns a file-like object streaming the content of this file"""
+        return self.nexus.open_file(f"/{self.repository_name}/{self.path}")
+
     def delete(self):
         """
             delete this file in the repository
@@ -162,6 +275,10 @@ class NexusRepository:
         self._user = user
         self._password = password
 
+        # Shared by all the requests, such that connections to Nexus are kept
+        # alive and reused rather than opened (and TLS negotiated) each time
+        self._session = requests.Session()
+
     def _get_headers(self):
         return {
             'Authorization': 'Basic %s' % (b64encode(b':'.join((self._user.encode('latin1'),
@@ -175,7 +292,7 @@ class NexusRepository:
         """
         headers = self._get_headers()
         url = self._url + "/repository" + repository_path
-        response = requests.get(url, headers=headers, stream=True)
+        response = self._session.get(url, headers=headers, stream=True)
 
         if response.status_code == 200:
             with open(target_file_path, 'wb') as f:
@@ -186,6 +303,34 @@ class NexusRepository:
 
         return response
 
+    def open_file(self, repository_path):
+        """
+            Opens the given file for streaming and returns a file-like object
+            on its content, so that it can be consumed (for example untarred)
+            while it is being downloaded.
+
+            path: path below the "repository", such as:
+                konverso_doc-release/aa.tar.gz"
+        """
+        headers = self._get_headers()
+        url = self._url + "/repository" + repository_path
+
+        # Large files are fetched through parallel range requests
+        # when Nexus supports them
+        response = self._session.head(url, headers=headers)
+        if response.status_code == 200 and response.headers.get("Accept-Ranges") == "bytes":
+            size = int(response.headers.get("Content-Length") or 0)
+            if size > 2 * RANGE_CHUNK_SIZE:
+                return RangeReader(self._session, url, headers, size)
+
+        response = self._session.get(url, headers=headers, stream=True)
+
+        if response.status_code != 200:
+            raise HttpError(response, f"Failed to load file '{repository_path}'")
+
+        response.raw.decode_content = True
+        return response.raw
+
 
     def list_assets(self, repository_name=""):
         return self.list_repository(repository_name)
@@ -216,7 +361,7 @@ class NexusRepository:
             https://nexus.konverso.ai/.../jira_fe477f079a60bd37c45b17a1b578988d428168d7.tar.gz
         """
         headers = self._get_headers()
-        response = requests.delete(target_file_path, headers=headers)
+        response = self._session.delete(target_file_path, headers=headers)
         if response.status_code == 204:
             print(f"'{target_file_path}' has been deleted")
         else:
@@ -234,7 +379,7 @@ class NexusRepository:
         if continuationToken:
             url += f"&continuationToken={continuationToken}"
 
-        response = requests.get(url, headers=headers)
+        response = self._session.get(url, headers=headers)
 
         if not response.status_code == 200:
             print(f"Failed accessing URL: {url}")
@@ -262,7 +407,7 @@ class NexusRepository:
         headers["Content-Type"] = "application/json"
 
         url = self._url + f"/service/rest/v1/search?repository={repository}"
-        response = requests.get(url, headers=headers)
+        response = self._session.get(url, headers=headers)
 
         if not response.status_code == 200:
             raise HttpError(response)
@@ -141,6 +141,7 @@ class Installer:
         self._ReadParameters()
         self._SelectInstallationType()
         self._ValidateLicense()
+        self._SetDatabaseVariables()
         self._ValidateDatabaseParameters()
         self._ValidatePgBouncer()
         self._ValidateAdminPassword()
@@ -149,8 +150,6 @@ class Installer:
         self._ValidateHostname()
         self._UpdatePythonPackages()
 
-        self._SetDatabaseVariables()
-
         if self.db_internal:
             self._SetupDatabase()
         else:
@@ -379,8 +378,8 @@ class Installer:
                 self.db_password = input("Enter a password for database user [%s]: "%self.db_password).strip() or self.db_password
 
                 if not self.db_internal:
-                    if os.system("export PGPASSWORD='%s';%s -h %s -p %s -d %s -U %s -c 'select 1' > /dev/null"\
-                            %(self.db_password, pg_psql, self.db_host, self.db_port, self.db_name, self.db_user)) == 0:
+                    if self._RunCommand([self.pg_psql, '-h', self.db_host, '-p', str(self.db_port), '-d', self.db_name,
+                                         '-U', self.db_user, '-c', 'select 1'], env=self._PgEnv(), quiet=True) == 0:
                         break
                     print("Can't connect to an external database with specified parameters!")
                 else:
@@ -497,7 +496,6 @@ class Installer:
 
                     if password != confirm_password:
                         print("Passwords are not the same")
-                        sys.stdout.flush()
                     else:
                         self.admin_password = utils.SafeEncrypt(password)
                         break
@@ -518,7 +516,6 @@ class Installer:
                     confirm_password = sys.stdin.readline().rstrip()
                 if password != confirm_password:
                     print("Passwords are not the same")
-                    sys.stdout.flush()
                 else:
                     self.redis_pwd = password
                     break
@@ -635,7 +632,6 @@ class Installer:
                 else:
                     if not self.update:
                         print("Didn't find '%s' certificate. Will generate certificates.\n" % (name))
-                        sys.stdout.flush()
                         os.system(os.path.join(self.target, 'bin', 'gen_redis_certs.sh'))
                         self._UpdateRedisCertificatesPaths()
                         break
@@ -697,105 +693,139 @@ class Installer:
     def _SetupExternalDatabase(self):
         # load database schema definition
         print("Loading tables to external database...")
-        sys.stdout.flush()
-        for product in reversed(self.products):
-            sqlfile = os.path.join(self.path, product.name, 'db', 'init', 'db_schema.sql')
-            if os.path.exists(sqlfile):
-                if os.system("export PGPASSWORD='%s';%s -q -h %s -p %s -d %s -U %s -f %s"\
-                             %(self.db_password, self.pg_psql, self.db_host, self.db_port, self.db_name, self.db_user, sqlfile)) != 0:
-                    print("Error: can't load tables! Aborting...")
-                    sys.exit(1)
+        script = self._SchemaScript()
+        if script and self._RunSql(script, on_error_stop=False) != 0:
+            print("Error: can't load tables! Aborting...")
+            sys.exit(1)
 
 
     def _SetDatabaseVariables(self):
-        pg_dir = os.environ['PG_DIR']
+        """Locate the PostgreSQL binaries, used for both the internal and external database"""
+        pg_dir = os.environ.get('PG_DIR')
+        if not pg_dir:
+            print("Error: PG_DIR is not set, can't locate the PostgreSQL binaries! Aborting...")
+            sys.exit(1)
         pg_bin = os.path.join(pg_dir, 'bin')
         self.pg_ctl = os.path.join(pg_bin, 'pg_ctl')
         self.pg_psql = os.path.join(pg_bin, 'psql')
 
+    def _StopDatabase(self):
+        self._RunCommand([self.pg_ctl, '-D', os.path.join(self.target, 'var', 'db'), '--silent', 'stop'])
+
+    def _AbortInstallation(self, message):
+        """Print the error message and exit, stopping the internal database if any"""
+        print(message)
+        if self.db_internal:
+            self._StopDatabase()
+        sys.exit(1)
+
+    def _RunSql(self, script, variables=None, on_error_stop=True):
+        """Run the SQL script as the database user, in a single psql session on
+        either the internal or the external database, and return the psql exit code.
+        The optional variables are given to psql, to be referenced as :'name' in the script.
+        Unless on_error_stop is False, the script stops on the first failed statement
+        """
+        command = [self.pg_psql, '-q', '-p', str(self.db_port), '-d', self.db_name, '-U', self.db_user]
+        if on_error_stop:
+            command += ['-v', 'ON_ERROR_STOP=1']
+        env = None
+        if not self.db_internal:
+            command += ['-h', self.db_host]
+            env = self._PgEnv()
+        for name, value in (variables or {}).items():
+            command += ['-v', '%s=%s' % (name, value)]
+        return self._RunCommand(command + ['-f', '-'], env=env, input_text=script)
+
     def _SetupDatabase(self):
         pg_data = os.path.join(self.target, 'var', 'db')
 
         if not os.path.exists(os.path.join(pg_data, 'PG_VERSION')):
             print("\nInstalling PostgreSQL server...")
-            sys.stdout.flush()
             try:
-                result = self._CommandOutput([self.pg_ctl, '-D', pg_data, '-o', '"-E UTF8"', '-o', '"--locale=en_US.utf8"', 'initdb'])
+                self._CommandOutput([self.pg_ctl, '-D', pg_data, '-o', '"-E UTF8"', '-o', '"--locale=en_US.utf8"', 'initdb'])
             except subprocess.CalledProcessError:
                 print("Cannot init database! Aborting...")
                 sys.exit(1)
 
         try:
-            result = self._CommandOutput([self.pg_ctl, 'status', '--silent', '-D', pg_data])
+            self._CommandOutput([self.pg_ctl, 'status', '--silent', '-D', pg_data])
         except subprocess.CalledProcessError:
-            # DB is not up, try to start it
+            # DB is not up, try to start it. With -w, pg_ctl only returns once the
+            # server accepts connections, and fails if it could not start
             print("Starting PostgreSQL server...")
-            sys.stdout.flush()
-            os.system("%s start -l %s/logs/postgres.log -D %s --silent -w -o '-p %s'" % (self.pg_ctl, self.target, pg_data, self.db_port))
-
-        #pg_status = os.system('%s status --silent -D %s' % (self.pg_ctl, pg_data))
-        try:
-            result = self._CommandOutput([self.pg_ctl, 'status', '--silent', '-D', pg_data])
-        except subprocess.CalledProcessError:
-            #if pg_status != 0:
-            print(result)
-            print("Error: can't start PostgreSQL server! Aborting...")
-            sys.exit(1)
-
-        # create PostgreSQL user if not exists
-        pg_user_exists = self._CommandOutput([self.pg_psql, 'postgres', '-t', '-A', '-p', self.db_port,
-                                              '-c', "SELECT count(*) FROM pg_user WHERE usename = '%s'"%self.db_user])
-        if pg_user_exists == "0":
-            print("Creating PostgreSQL user %s..." % self.db_user)
-            sys.stdout.flush()
-            os.system('%s postgres -q -p %s -c "CREATE USER %s PASSWORD \'%s\'"'%(self.pg_psql, self.db_port, self.db_user, self.db_password))
-        else:
-            print("PostgreSQL user %s already exists."%self.db_user)
-
-        # create PostgreSQL database if not exists
-        pg_db_exists = self._CommandOutput([self.pg_psql, 'postgres', '-t', '-A', '-p', self.db_port,
-                                            '-c', "SELECT count(*) FROM pg_database WHERE datname = '%s'" % self.db_name])
-        if pg_db_exists == "0":
-            print("Creating PostgreSQL database %s..." % self.db_name)
-            sys.stdout.flush()
-            os.system('%s postgres -q -p %s -c "CREATE DATABASE %s ENCODING \'UTF8\' OWNER %s"'%(self.pg_psql, self.db_port, self.db_name, self.db_user))
-            os.system('%s -q -p %s %s -c "ALTER SCHEMA public OWNER TO %s"'%(self.pg_psql, self.db_port, self.db_name, self.db_user))
-            os.system('%s -q -p %s %s -c "ALTER SYSTEM SET max_connections TO \'512\'"'%(self.pg_psql, self.db_port, self.db_name))
-        else:
-            print("PostgreSQL database %s already exists." % self.db_name)
+            if self._RunCommand([self.pg_ctl, 'start', '-l', os.path.join(self.target, 'logs', 'postgres.log'),
+                                 '-D', pg_data, '--silent', '-w', '-o', '-p %s' % self.db_port]) != 0:
+                print("Error: can't start PostgreSQL server! Aborting...")
+                sys.exit(1)
 
-        sys.stdout.flush()
+        # Check for the PostgreSQL user and database, and create the missing
+        # ones, in a single psql session. The user, password and database names
+        # are given to psql as variables, for it to quote them as literals
+        # (:'name') or identifiers (:"name")
+        script = r"""
+SELECT EXISTS (SELECT 1 FROM pg_user WHERE usename = :'db_user') AS user_exists,
+       EXISTS (SELECT 1 FROM pg_database WHERE datname = :'db_name') AS db_exists \gset
+\if :user_exists
+\echo PostgreSQL user :db_user already exists.
+\else
+\echo Creating PostgreSQL user :db_user...
+CREATE USER :"db_user" PASSWORD :'db_password';
+\endif
+\if :db_exists
+\echo PostgreSQL database :db_name already exists.
+\else
+\echo Creating PostgreSQL database :db_name...
+CREATE DATABASE :"db_name" ENCODING 'UTF8' OWNER :"db_user";
+\c :"db_name"
+ALTER SCHEMA public OWNER TO :"db_user";
+ALTER SYSTEM SET max_connections TO '512';
+\endif
+"""
+        if self._RunCommand([self.pg_psql, 'postgres', '-q', '-v', 'ON_ERROR_STOP=1', '-p', str(self.db_port),
+                             '-v', 'db_user=%s' % self.db_user, '-v', 'db_name=%s' % self.db_name,
+                             '-v', 'db_password=%s' % self.db_password, '-f', '-'], input_text=script) != 0:
+            self._AbortInstallation("Error: can't create PostgreSQL user or database! Aborting...")
 
         if self.db_dump:
             self._InitializeDatabaseFromDump()
         else:
             self._InitializeDatabaseFromScratch()
 
+    def _SchemaFiles(self):
+        """List the existing product schema files, in loading order"""
+        schema = os.path.join('db', 'init', 'db_schema.sql')
+        sqlfiles = []
+        for product in reversed(self.products):
+            sqlfile = os.path.join(self.path, product.name, schema)
+            if os.path.isfile(sqlfile):
+                sqlfiles.append(sqlfile)
+        return sqlfiles
+
+    def _SchemaScript(self):
+        """psql script loading all the product schemas in a single session.
+        Each file is followed by a DISCARD ALL, such that it starts from a clean
+        session as it would with its own psql process
+        """
+        return "".join("\\i '%s'\nDISCARD ALL;\n" % sqlfile for sqlfile in self._SchemaFiles())
+
     def _InitializeDatabaseFromDump(self):
         print("=> Will initialize database from a dump")
 
-        cmd = '%s -v ON_ERROR_STOP=1 %s -U %s -h %s -p %s -q -c "DROP OWNED BY %s"'
-        cmd = cmd % (self.pg_psql, self.db_name, "konverso", "localhost", self.db_port, self.db_user)
-        os.system(cmd)
+        self._RunCommand([self.pg_psql, '-v', 'ON_ERROR_STOP=1', self.db_name, '-U', 'konverso', '-h', 'localhost',
+                          '-p', str(self.db_port), '-q', '-c', "DROP OWNED BY %s" % self.db_user])
 
-        cmd = '%s -v ON_ERROR_STOP=1 %s -U %s -h %s -p %s -q -f %s  > /dev/null'
-        cmd = cmd % (self.pg_psql, self.db_name, self.db_user, "localhost", self.db_port, self.db_dump)
-        os.system(cmd)
+        self._RunCommand([self.pg_psql, '-v', 'ON_ERROR_STOP=1', self.db_name, '-U', self.db_user, '-h', 'localhost',
+                          '-p', str(self.db_port), '-q', '-f', self.db_dump], quiet=True)
         print("=> PostgreSQL dump loaded")
 
 
     def _InitializeDatabaseFromScratch(self):
         print("=> Initializing database tables...")
-        for product in reversed(self.products):
-            sqlfile = os.path.join(self.path, product.name, 'db', 'init', 'db_schema.sql')
-            if os.path.exists(sqlfile):
-                if os.system('%s -q -v ON_ERROR_STOP=1 -p %s %s -U %s -f %s'\
-                             %(self.pg_psql, self.db_port, self.db_name, self.db_user, sqlfile)) != 0:
-                    print("Error: can't init DB schema! Aborting...")
-                    os.system('%s -D %s/var/db --silent stop'%(self.pg_ctl, self.target))
-                    sys.exit(1)
 
-        sys.stdout.flush()
+        script = self._SchemaScript()
+        if script and self._RunSql(script) != 0:
+            self._AbortInstallation("Error: can't init DB schema! Aborting...")
+
         print("=> PostgreSQL DB loaded")
 
     def _LoadAndLearn(self):
@@ -805,55 +835,38 @@ class Installer:
         self._Makedirs(varpkl)
 
         Env().varhome = os.path.join(self.target, 'var')
-        # Setup predefined classifiers
+        # Setup predefined classifiers, all saved within a single psql session
+        learn_time = utils.GetStringTime(datetime.datetime.now())
+        script = ""
         for fname in os.listdir(varpkl):
             name = os.path.basename(fname).split('.')[0]
             obj = MLObject(name)
             obj.LoadPickle()
             for lang in obj._models:
                 variable = 'classifier.%s.%s.learn'%(name, lang)
-                query = """insert into kbot_settings (variable, value) values(\'%s\', \'%s\')
-                           on conflict (variable) do update set value=EXCLUDED.value
-                        """%(variable, utils.GetStringTime(datetime.datetime.now()))
-                if self.db_internal:
-                    if os.system('%s -q -p %s %s -c "%s"'%(self.pg_psql, self.db_port, self.db_name, query)) != 0:
-                        print("Error: can't save predefined classifiers! Aborting...")
-                        os.system('%s -D %s/var/db --silent stop'%(pg_ctl, self.target))
-                        sys.exit(1)
-                elif os.system("""export PGPASSWORD='%s';%s -q -h %s -p %s -d %s -U %s -c "%s"
-                               """%(self.db_password, self.pg_psql, self.db_host, self.db_port, self.db_name, self.db_user, query)) != 0:
-                    print("Error: can't save predefined classifiers! Aborting...")
-                    sys.exit(1)
+                script += """insert into kbot_settings (variable, value) values(\'%s\', \'%s\')
+                           on conflict (variable) do update set value=EXCLUDED.value;
+                        """%(variable, learn_time)
+
+        if script and self._RunSql(script) != 0:
+            self._AbortInstallation("Error: can't save predefined classifiers! Aborting...")
 
         if not self.no_load and not self.db_dump:
             print("Loading data...")
-            sys.stdout.flush()
-            if os.system('%s/bin/kbot.sh load'%self.target) != 0:
-                print("Error during loading! Aborting...")
-                os.system('%s -D %s/var/db --silent stop'%(pg_ctl, self.target))
-                sys.exit(1)
+            if self._RunCommand([os.path.join(self.target, 'bin', 'kbot.sh'), 'load']) != 0:
+                self._AbortInstallation("Error during loading! Aborting...")
 
             if self.admin_password:
-                _db_request = f"UPDATE users_im_account SET pwd=\'{self.admin_password}\' "
-                _db_request += "WHERE user_id=(SELECT users.user_id FROM users WHERE users.user_name=\'admin\')"
-                if self.db_internal:
-                    if os.system('%s -q -p %s %s -U %s -c "%s"'\
-                                 %(self.pg_psql, self.db_port, self.db_name, self.db_user, _db_request)) != 0:
-                        print("Error: can't setup admin password! Aborting...")
-                        os.system('%s -D %s/var/db --silent stop'%(pg_ctl, self.target))
-                        sys.exit(1)
+                _db_request = "UPDATE users_im_account SET pwd=:'admin_password' "
+                _db_request += "WHERE user_id=(SELECT users.user_id FROM users WHERE users.user_name=\'admin\');"
                 # setup admin password
-                elif os.system('export PGPASSWORD=\'%s\';%s -q -h %s -p %s %s -U %s -c "%s"'\
-                                 %(self.db_password, self.pg_psql, self.db_host, self.db_port, self.db_name, self.db_user, _db_request)) != 0:
-                    print("Error: can't setup admin password! Aborting...")
-                    sys.exit(1)
+                if self._RunSql(_db_request, {'admin_password': self.admin_password}) != 0:
+                    self._AbortInstallation("Error: can't setup admin password! Aborting...")
 
         if not self.no_learn:
             print("Learning models...")
-            if os.system('%s/bin/kbot.sh learn'%self.target) != 0:
-                print("Error during learning! Aborting...")
-                os.system('%s -D %s/var/db --silent stop'%(pg_ctl, self.target))
-                sys.exit(1)
+            if self._RunCommand([os.path.join(self.target, 'bin', 'kbot.sh'), 'learn']) != 0:
+                self._AbortInstallation("Error during learning! Aborting...")
 
     def _StartInstallation(self):
         print("You are about to install Konverso Kbot")
@@ -873,8 +886,7 @@ class Installer:
 
         if self.db_internal:
             print("Shutting down PostgreSQL server...")
-            os.system('%s -D %s/var/db --silent stop' %
-                      (self.pg_ctl, self.target))
+            self._StopDatabase()
 
         local_kbot_conf = os.path.join(self.target, 'conf', 'kbot.conf')
         if os.path.exists(local_kbot_conf):
@@ -1111,6 +1123,21 @@ class Installer:
         #    print("Failed running", command)
         return res
 
+    def _RunCommand(self, command, env=None, quiet=False, input_text=None):
+        """Run the command (an argument list, no shell) and return its exit code.
+        The optional input_text is given to the command on its standard input
+        """
+        stdout = subprocess.DEVNULL if quiet else None
+        return subprocess.run(command, env=env, stdout=stdout, input=input_text, text=True, check=False).returncode
+
+    def _PgEnv(self):
+        """Environment for psql commands on the external database.
+        The password is passed through PGPASSWORD rather than on a command line
+        """
+        env = dict(os.environ)
+        env['PGPASSWORD'] = str(self.db_password)
+        return env
+
 def usage():
     print("""
 
@@ -1152,6 +1179,11 @@ def usage():
 
 if __name__ == '__main__':
 
+    # The output is usually piped to the install log, where it would otherwise
+    # be block buffered: each line must go out before any command we run writes
+    # to the same stream, and for the progress to show while it is running
+    sys.stdout.reconfigure(line_buffering=True)
+
     import argparse
     try:
         parser = argparse.ArgumentParser(prog='setup_workarea')
@@ -0,0 +1,6 @@
+"""Shared setup for the installer scripts tests."""
+import os
+import sys
+
+# The installer scripts are top-level modules of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
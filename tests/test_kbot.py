@@ -0,0 +1,140 @@
+"""Tests for the streamed untar of kbot._extract_tar_stream."""
+import errno
+import io
+import os
+import tarfile
+import time
+
+import pytest
+
+import kbot
+
+
+# Smaller than the default, for the archive to hold both in memory and streamed files
+IN_MEMORY_SIZE = 4096
+
+
+def _add(tf, name, type=tarfile.REGTYPE, data=b"", mode=0o644, mtime=1600000000, linkname=""):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.mtime = mtime
+    info.uid = os.getuid()
+    info.gid = os.getgid()
+    info.linkname = linkname
+    info.size = len(data)
+    tf.addfile(info, io.BytesIO(data) if type == tarfile.REGTYPE else None)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "product.tar.gz"
+    with tarfile.open(path, "w:gz") as tf:
+        _add(tf, "product", tarfile.DIRTYPE, mode=0o755, mtime=1500000000)
+        _add(tf, "product/bin", tarfile.DIRTYPE, mode=0o750, mtime=1500000001)
+        for index in range(200):
+            _add(tf, f"product/lib/module{index}.py", data=os.urandom(index * 37),
+                 mode=0o755 if index % 5 == 0 else 0o644, mtime=1600000000 + index)
+        # Directory members may come after their files, which create them
+        _add(tf, "product/lib", tarfile.DIRTYPE, mode=0o755, mtime=1500000003)
+        # Hard links to a file right after it, which must be written first
+        _add(tf, "product/bin/large", data=os.urandom(5 * IN_MEMORY_SIZE), mode=0o700)
+        _add(tf, "product/bin/large_link", tarfile.LNKTYPE, linkname="product/bin/large")
+        _add(tf, "product/bin/small", data=b"#!/bin/sh\n", mode=0o755)
+        _add(tf, "product/bin/small_link", tarfile.LNKTYPE, linkname="product/bin/small")
+
+        # The last member with a given path wins, whether kept in memory or not
+        _add(tf, "product/dup/small_then_small", data=b"first")
+        _add(tf, "product/dup/small_then_small", data=b"second", mode=0o600)
+        _add(tf, "product/dup/small_then_large", data=b"first")
+        _add(tf, "product/dup/small_then_large", data=os.urandom(2 * IN_MEMORY_SIZE), mode=0o600)
+        _add(tf, "product/dup/large_then_small", data=os.urandom(2 * IN_MEMORY_SIZE))
+        _add(tf, "product/dup/large_then_small", data=b"second", mode=0o600)
+        _add(tf, "product/dup", tarfile.DIRTYPE, mode=0o700, mtime=1500000004)
+
+        _add(tf, "product/lib/latest.py", tarfile.SYMTYPE, linkname="module199.py")
+
+        # Attributes set last, once the directory content is written
+        _add(tf, "product/readonly", tarfile.DIRTYPE, mode=0o555, mtime=1500000002)
+        _add(tf, "product/readonly/data", data=b"data", mode=0o444)
+    return path
+
+
+def _snapshot(root):
+    """The content, mode, modification time and link count of all the entries below root"""
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            mtime = stat.st_mtime
+            if os.path.islink(path):
+                # tarfile does not set the time of symbolic links
+                content, mtime = os.readlink(path), None
+            elif os.path.isfile(path):
+                with open(path, "rb") as fd:
+                    content = fd.read()
+            else:
+                content = None
+            snapshot[os.path.relpath(path, root)] = (content, stat.st_mode, mtime, stat.st_nlink)
+    return snapshot
+
+
+def _extract_stream(archive, path):
+    with open(archive, "rb") as stream, kbot._open_tar_stream(stream) as tf:
+        kbot._extract_tar_stream(tf, str(path))
+
+
+@pytest.mark.parametrize("isal", [True, False])
+@pytest.mark.parametrize("write_delay", [0, 0.01])
+def test_extract_tar_stream_matches_extractall(archive, tmp_path, monkeypatch, isal, write_delay):
+    if isal and kbot.igzip_threaded is None:
+        pytest.skip("isal is not installed")
+    if not isal:
+        monkeypatch.setattr(kbot, "igzip_threaded", None)
+    monkeypatch.setattr(kbot, "EXTRACT_IN_MEMORY_SIZE", IN_MEMORY_SIZE)
+
+    # Slow writes keep the threads behind the archive reading, for the files
+    # they write to be still pending when a later member depends on them
+    written = []
+
+    def slow_open(path, mode):
+        time.sleep(write_delay)
+        written.append(os.path.basename(path))
+        return open(path, mode)
+
+    monkeypatch.setattr(kbot, "open", slow_open, raising=False)
+
+    with tarfile.open(archive) as tf:
+        tf.extractall(tmp_path / "expected")
+    _extract_stream(archive, tmp_path / "extracted")
+
+    expected = _snapshot(tmp_path / "expected")
+    assert len(expected) == 214
+    assert _snapshot(tmp_path / "extracted") == expected
+
+    # Large files are not loaded in memory for the threads to write them
+    assert "large" not in written and "small" in written
+
+
+def test_extract_tar_stream_raises_write_errors_early(archive, tmp_path, monkeypatch):
+    def set_tar_attributes(tf, member, targetpath):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(kbot, "_set_tar_attributes", set_tar_attributes)
+
+    members = []
+    with open(archive, "rb") as stream, kbot._open_tar_stream(stream) as tf:
+        next_member = tf.next
+
+        def counting_next():
+            members.append(next_member())
+            return members[-1]
+
+        monkeypatch.setattr(tf, "next", counting_next)
+        with pytest.raises(OSError) as error:
+            kbot._extract_tar_stream(tf, str(tmp_path / "extracted"))
+
+    assert error.value.errno == errno.ENOSPC
+    # Raised on the first failed writes, not once the whole archive is read
+    assert len(members) < 100
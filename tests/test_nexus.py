@@ -0,0 +1,128 @@
+"""Tests for nexus.RangeReader."""
+import http.server
+import os
+import re
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+import nexus
+from nexus import HttpError, RangeReader
+
+
+CHUNK_SIZE = 256 * 1024
+DATA = os.urandom(8 * CHUNK_SIZE + 1000)
+# Truncated responses are cut after this many bytes
+TRUNCATED_SIZE = CHUNK_SIZE // 2
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA by range, misbehaving on the chunk offsets listed in server.faults"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        start, end = int(match[1]), int(match[2])
+        body = DATA[start:end + 1]
+        self.server.requests.append(start)
+        fault = self.server.faults.pop(start, None)
+
+        if fault == "error":
+            self.server.faults[start] = fault
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if fault == "truncate":
+            # Drop the connection in the middle of the body, only once
+            self.wfile.write(body[:TRUNCATED_SIZE])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+        elif fault == "stall":
+            self.wfile.write(body[:100])
+            self.wfile.flush()
+            self.server.released.wait()
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def range_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    server.daemon_threads = True
+    server.faults = {}
+    server.requests = []
+    server.released = threading.Event()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/file.tar.gz"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.released.set()
+    server.shutdown()
+    server.server_close()
+
+
+def _reader(server, connections=4):
+    return RangeReader(requests.Session(), server.url, {}, len(DATA),
+                       connections=connections, chunk_size=CHUNK_SIZE)
+
+
+@pytest.mark.parametrize("connections", [1, 4])
+def test_read_returns_the_chunks_in_order(range_server, connections):
+    with _reader(range_server, connections) as reader:
+        assert reader.read() == DATA
+
+    assert sorted(range_server.requests) == list(range(0, len(DATA), CHUNK_SIZE))
+
+
+def test_interrupted_chunk_is_resumed(range_server):
+    range_server.faults = {0: "truncate", 5 * CHUNK_SIZE: "truncate"}
+
+    with _reader(range_server) as reader:
+        assert reader.read() == DATA
+
+    # Each truncated chunk is requested again from the data received
+    resumed = sorted(start for start in range_server.requests if start % CHUNK_SIZE)
+    assert len(resumed) == 2
+    for chunk_start, start in zip((0, 5 * CHUNK_SIZE), resumed):
+        assert chunk_start < start <= chunk_start + TRUNCATED_SIZE
+
+
+def test_http_error_propagates_to_the_reader(range_server):
+    range_server.faults = {3 * CHUNK_SIZE: "error"}
+
+    with _reader(range_server) as reader:
+        for index in range(3):
+            assert reader.read(CHUNK_SIZE) == DATA[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        with pytest.raises(HttpError) as error:
+            reader.read(CHUNK_SIZE)
+
+    assert error.value.response.status_code == 500
+
+
+def test_close_stops_the_running_requests(range_server, monkeypatch):
+    monkeypatch.setattr(nexus, "RANGE_TIMEOUT", 30)
+    range_server.faults = {CHUNK_SIZE: "stall"}
+
+    reader = _reader(range_server)
+    assert reader.read(CHUNK_SIZE) == DATA[:CHUNK_SIZE]
+    reader.close()
+
+    # The stalled request is aborted rather than waiting for its timeout and retries
+    start = time.monotonic()
+    reader._executor.shutdown(wait=True)
+    assert time.monotonic() - start < 5